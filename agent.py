@@ -1,5 +1,8 @@
+import asyncio
+
 from uagents import Agent, Context
 from chat_proto import chat_proto
+from evitsam import PNG_RECOMPRESSION_AVAILABLE, get_client
 
 agent = Agent(
     name="EfficientViT SAM Agent",
@@ -11,5 +14,17 @@ agent = Agent(
 
 agent.include(chat_proto, publish_manifest=True)
 
+@agent.on_event("startup")
+async def warm_up_sam_client(ctx: Context):
+    # Connect to the SAM Space up front so the first request doesn't pay for it
+    try:
+        await asyncio.to_thread(get_client)
+        ctx.logger.info("Connected to EfficientViT SAM")
+    except Exception as e:
+        ctx.logger.warning(f"Could not connect to EfficientViT SAM yet: {e}")
+    
+    if not PNG_RECOMPRESSION_AVAILABLE:
+        ctx.logger.info("Pillow is not installed; segmented images will be uploaded without recompression")
+
 if __name__ == "__main__":
     agent.run()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from datetime import datetime, timezone
 from uuid import uuid4
@@ -18,14 +19,48 @@ from uagents_core.contrib.protocols.chat import (
 from pydantic.v1 import UUID4
 from uagents_core.storage import ExternalStorage
 
-from evitsam import get_image
+from evitsam import LRUCache, content_hash, get_image, optimize_png
 
 STORAGE_URL = os.getenv("AGENTVERSE_URL", "https://agentverse.ai") + "/v1/storage"
 AGENTVERSE_API_KEY = os.getenv("AGENTVERSE_API_KEY")
 if AGENTVERSE_API_KEY is None:
     raise ValueError("You need to provide an API_TOKEN.")
 
-external_storage = ExternalStorage(api_token=AGENTVERSE_API_KEY, storage_url=STORAGE_URL)
+# One ExternalStorage per credential instead of one per message. This only saves the
+# constructor: the client has no HTTP session, and identity auth signs each request.
+_STORAGE_CACHE: dict[tuple[str, str], ExternalStorage] = {}
+
+def _get_storage(identity=None) -> ExternalStorage:
+    key = (identity.address if identity is not None else "apikey", STORAGE_URL)
+    storage = _STORAGE_CACHE.get(key)
+    if storage is None:
+        if identity is not None:
+            storage = ExternalStorage(identity=identity, storage_url=STORAGE_URL)
+        else:
+            storage = ExternalStorage(api_token=AGENTVERSE_API_KEY, storage_url=STORAGE_URL)
+        _STORAGE_CACHE[key] = storage
+    return storage
+
+external_storage = _get_storage()
+
+# Caps how many messages can hold downloaded images at once, from download through SAM
+MAX_CONCURRENT_IMAGES = 8
+_IMAGE_SLOTS: asyncio.Semaphore | None = None
+_IMAGE_SLOTS_LOOP: asyncio.AbstractEventLoop | None = None
+
+def _get_image_slots() -> asyncio.Semaphore:
+    global _IMAGE_SLOTS, _IMAGE_SLOTS_LOOP
+    # A semaphore is bound to the loop it is first used on, so make one per running loop
+    loop = asyncio.get_running_loop()
+    if _IMAGE_SLOTS is None or _IMAGE_SLOTS_LOOP is not loop:
+        _IMAGE_SLOTS = asyncio.Semaphore(MAX_CONCURRENT_IMAGES)
+        _IMAGE_SLOTS_LOOP = loop
+    return _IMAGE_SLOTS
+
+# Asset IDs of previously uploaded segmented images, keyed by content digest
+# Entries expire well before the assets do (create_asset defaults to a 24 h lifetime)
+ASSET_CACHE_TTL = 12 * 60 * 60
+_ASSET_CACHE = LRUCache(maxsize=128, ttl=ASSET_CACHE_TTL)
 
 def create_text_chat(text: str) -> ChatMessage:
     return ChatMessage(
@@ -63,6 +98,64 @@ def create_resource_chat(asset_id: str, uri: str) -> ChatMessage:
         ]
     )
 
+def _upload_and_permission(
+    segmented_image: bytes, sender: str, asset_id: str | None = None
+) -> tuple[str, str, bool]:
+    external_storage = _get_storage()
+    
+    # Reuse an earlier asset with the same contents, unless it has since expired or been deleted
+    if asset_id is not None:
+        try:
+            external_storage.set_permissions(asset_id=asset_id, agent_address=sender)
+            return asset_id, f"agent-storage://{STORAGE_URL}/{asset_id}", False
+        except Exception:
+            pass
+    
+    asset_id = external_storage.create_asset(
+        name=f"segmented_{uuid4()}",
+        content=optimize_png(segmented_image),
+        mime_type="image/png"
+    )
+    external_storage.set_permissions(asset_id=asset_id, agent_address=sender)
+    return asset_id, f"agent-storage://{STORAGE_URL}/{asset_id}", True
+
+async def _on_start_session(ctx: Context, sender: str, item: StartSessionContent, state: dict):
+    ctx.logger.info(f"Got a start session message from {sender}")
+    # Send in the background so it doesn't hold up the remaining content
+    state["pending"].append(
+        asyncio.create_task(ctx.send(sender, create_metadata({"attachments": "true"})))
+    )
+
+async def _on_text(ctx: Context, sender: str, item: TextContent, state: dict):
+    ctx.logger.info(f"Got text: {item.text}")
+    state["content_items"].append({
+        "type": "text",
+        "text": item.text
+    })
+
+async def _on_resource(ctx: Context, sender: str, item: ResourceContent, state: dict):
+    # Skip the download when the sender already told us this isn't an image
+    resource = item.resource
+    if isinstance(resource, list):
+        resource = resource[0] if resource else None
+    mime_type = (resource.metadata or {}).get("mime_type", "") if resource else ""
+    if mime_type and not mime_type.startswith("image/"):
+        ctx.logger.info(f"Skipping non-image resource ({mime_type}) from {sender}")
+        state["content_items"].append({"type": "resource", "mime_type": mime_type})
+        return
+    
+    ctx.logger.info(f"Processing resource from {sender}")
+    # Reserve the item's slot so content order is kept once downloads finish
+    state["resource_items"].append((len(state["content_items"]), item))
+    state["content_items"].append(None)
+
+# Content type -> handler; adding a new content type only needs an entry here
+_CONTENT_HANDLERS = {
+    StartSessionContent: _on_start_session,
+    TextContent: _on_text,
+    ResourceContent: _on_resource,
+}
+
 chat_proto = Protocol(spec=chat_protocol_spec)
 
 @chat_proto.on_message(ChatMessage)
@@ -70,52 +163,82 @@ async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
     ctx.storage.set(str(ctx.session), sender)
     ctx.logger.info(f"Got a message from {sender}")
     
-    # Acknowledge the message first
-    await ctx.send(
-        sender,
-        ChatAcknowledgement(
-            timestamp=datetime.now(timezone.utc), 
-            acknowledged_msg_id=msg.msg_id
-        ),
+    # Acknowledge the message while its content is being processed
+    ack_task = asyncio.create_task(
+        ctx.send(
+            sender,
+            ChatAcknowledgement(
+                timestamp=datetime.now(timezone.utc), 
+                acknowledged_msg_id=msg.msg_id
+            ),
+        )
     )
+    state = {"content_items": [], "resource_items": [], "pending": [ack_task]}
+    try:
+        await _process_message(ctx, sender, msg, state)
+    finally:
+        # Wait for background sends and report any that failed
+        for result in await asyncio.gather(*state["pending"], return_exceptions=True):
+            if isinstance(result, Exception):
+                ctx.logger.error(f"Failed to send message to {sender}: {result}")
 
+async def _reply(ctx: Context, sender: str, message: ChatMessage, state: dict):
+    # Replies must not overtake the acknowledgement or session metadata being sent in the
+    # background; failures are reported once the handler finishes
+    await asyncio.wait(state["pending"])
+    await ctx.send(sender, message)
+
+async def _process_message(ctx: Context, sender: str, msg: ChatMessage, state: dict):
     # Collect all content items
-    content_items = []
-    has_image = False
     
     for item in msg.content:
-        if isinstance(item, StartSessionContent):
-            ctx.logger.info(f"Got a start session message from {sender}")
-            await ctx.send(sender, create_metadata({"attachments": "true"}))
-            continue
-        elif isinstance(item, TextContent):
-            ctx.logger.info(f"Got text: {item.text}")
-            content_items.append({
-                "type": "text",
-                "text": item.text
-            })
-        elif isinstance(item, ResourceContent):
-            try:
-                ctx.logger.info(f"Processing resource from {sender}")
-                external_storage = ExternalStorage(
-                    identity=ctx.agent.identity,
-                    storage_url=STORAGE_URL,
-                )
-                data = external_storage.download(str(item.resource_id))
-                if data and "contents" in data:
-                    content_items.append({
-                        "type": "resource",
-                        "mime_type": data.get("mime_type", "image/png"),
-                        "contents": data["contents"],
-                    })
+        handler = _CONTENT_HANDLERS.get(type(item))
+        if handler:
+            await handler(ctx, sender, item, state)
+    
+    # Take a slot before downloading and keep it until SAM is done, so decoded images
+    # held in memory stay bounded no matter how many messages arrive
+    if state["resource_items"]:
+        async with _get_image_slots():
+            await _process_content(ctx, sender, state)
+    else:
+        await _process_content(ctx, sender, state)
+
+async def _process_content(ctx: Context, sender: str, state: dict):
+    content_items = state["content_items"]
+    resource_items = state["resource_items"]
+    has_image = False
+
+    # Download all attached resources in parallel
+    if resource_items:
+        external_storage = _get_storage(ctx.agent.identity)
+        results = await asyncio.gather(
+            *(
+                asyncio.to_thread(external_storage.download, str(item.resource_id))
+                for _, item in resource_items
+            ),
+            return_exceptions=True,
+        )
+        for (index, _), data in zip(resource_items, results):
+            if isinstance(data, Exception):
+                ctx.logger.error(f"Failed to download resource: {data}")
+                await _reply(ctx, sender, create_text_chat("Failed to download resource."), state)
+                return
+            if data and "contents" in data:
+                mime_type = data.get("mime_type", "image/png")
+                content_items[index] = {
+                    "type": "resource",
+                    "mime_type": mime_type,
+                    "contents": data["contents"],
+                }
+                if mime_type.startswith("image/"):
                     has_image = True
                     ctx.logger.info("Successfully downloaded image resource")
                 else:
-                    ctx.logger.error("Downloaded resource has no contents")
-            except Exception as ex:
-                ctx.logger.error(f"Failed to download resource: {ex}")
-                await ctx.send(sender, create_text_chat("Failed to download resource."))
-                return
+                    ctx.logger.info(f"Downloaded resource is not an image ({mime_type})")
+            else:
+                ctx.logger.error("Downloaded resource has no contents")
+        content_items = [content for content in content_items if content is not None]
 
     # Process if we have an image
     if has_image:
@@ -124,39 +247,40 @@ async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
             segmented_image, analysis = await get_image(content_items)
             
             if segmented_image:
-                # Store the segmented image
-                asset_id = str(uuid4())
-                external_storage = ExternalStorage(
-                    api_token=AGENTVERSE_API_KEY,
-                    storage_url=STORAGE_URL,
-                )
-                asset_id = external_storage.create_asset(
-                    name=f"segmented_{asset_id}",
-                    content=segmented_image,
-                    mime_type="image/png"
-                )
+                # The asset cache is only touched here on the event loop, never from the upload thread
+                image_key = content_hash(segmented_image)
+                cached_asset_id = _ASSET_CACHE.get(image_key)
                 
-                ctx.logger.info(f"Created asset with ID: {asset_id}")
-                asset_uri = f"agent-storage://{STORAGE_URL}/{asset_id}"
+                # Upload in the background so the analysis reaches the user first
+                upload_task = asyncio.create_task(
+                    asyncio.to_thread(_upload_and_permission, segmented_image, sender, cached_asset_id)
+                )
+
+                try:
+                    # Send the analysis text if available
+                    if analysis:
+                        await _reply(ctx, sender, create_text_chat(analysis), state)
+                finally:
+                    # Always collect the upload, even if the analysis send failed
+                    asset_id, asset_uri, created = await upload_task
                 
-                # Set permissions
-                external_storage.set_permissions(asset_id=asset_id, agent_address=sender)
+                if created:
+                    _ASSET_CACHE.put(image_key, asset_id)
+                    if cached_asset_id is not None:
+                        ctx.logger.info(f"Cached asset {cached_asset_id} is no longer usable, re-uploaded")
+                    ctx.logger.info(f"Created asset with ID: {asset_id}")
                 ctx.logger.info(f"Set permissions for {sender} on asset {asset_id}")
-
-                # Send the analysis text if available
-                if analysis:
-                    await ctx.send(sender, create_text_chat(analysis))
                 
                 # Send the segmented image
-                await ctx.send(sender, create_resource_chat(asset_id, asset_uri))
+                await _reply(ctx, sender, create_resource_chat(asset_id, asset_uri), state)
             else:
-                await ctx.send(sender, create_text_chat(analysis or "Failed to process image."))
+                await _reply(ctx, sender, create_text_chat(analysis or "Failed to process image."), state)
                 
         except Exception as e:
             ctx.logger.error(f"Error processing image: {str(e)}", exc_info=True)
-            await ctx.send(sender, create_text_chat("Error processing image. Please try again."))
+            await _reply(ctx, sender, create_text_chat("Error processing image. Please try again."), state)
     elif content_items:  # Only text, no image
-        await ctx.send(sender, create_text_chat("Please send an image to analyze."))
+        await _reply(ctx, sender, create_text_chat("Please send an image to analyze."), state)
     else:
         ctx.logger.warning("No valid content found in message")
 
@@ -1,10 +1,18 @@
-import base64
+import asyncio
+import binascii
+import hashlib
+import importlib.util
 import io
 from typing import Tuple, Optional, Dict, Any
 from gradio_client import Client, handle_file
 import tempfile
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, partial
+from uuid import uuid4
 
 # Default SAM parameters based on the actual API
 DEFAULT_PARAMS = {
@@ -14,6 +22,163 @@ DEFAULT_PARAMS = {
     "box_nms_threshold": 0.7    # param_5: Box NMS threshold
 }
 
+# Allowed (min, max, type) for each SAM parameter
+PARAM_CLAMPS = {
+    "points_per_side": (1, 128, int),
+    "iou_threshold": (0.1, 1.0, float),
+    "stability_threshold": (0.1, 1.0, float),
+    "box_nms_threshold": (0.1, 1.0, float),
+}
+
+@lru_cache(maxsize=256)
+def _validate_params(raw_params: frozenset) -> Tuple[tuple, str]:
+    """
+    Clamp SAM parameters to their allowed ranges and build the matching analysis text.
+    Memoized because users tend to re-run the same settings.
+    
+    Returns:
+        Tuple of (sorted (name, value) pairs, analysis_text)
+    """
+    params = dict(raw_params)
+    for name, (low, high, cast) in PARAM_CLAMPS.items():
+        params[name] = max(low, min(high, cast(params[name])))
+    
+    analysis = (
+        f"Processed image with SAM parameters:\n"
+        f"- Points per side: {params['points_per_side']}\n"
+        f"- IoU threshold: {params['iou_threshold']:.2f}\n"
+        f"- Stability threshold: {params['stability_threshold']:.2f}\n"
+        f"- Box NMS threshold: {params['box_nms_threshold']:.2f}"
+    )
+    return tuple(sorted(params.items())), analysis
+
+SAM_URL = "https://evitsam.hanlab.ai/"
+
+# handle_file only accepts a path or URL, so stage uploads on RAM-backed storage when available
+TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# Shared Gradio client, created on first use so importing this module doesn't block
+_CLIENT: Optional[Client] = None
+_CLIENT_LOCK = threading.Lock()
+
+def get_client() -> Client:
+    """
+    Return the shared Gradio client, creating it on first use.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = Client(SAM_URL)
+    return _CLIENT
+
+class LRUCache:
+    """
+    Small least-recently-used cache backed by an OrderedDict.
+    Entries can optionally expire after ttl seconds, and the cache can be capped
+    by the total size callers report for their values. Not thread-safe.
+    """
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data: OrderedDict = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: Any) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires, _ = entry
+        if expires is not None and time.monotonic() >= expires:
+            self.pop(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: Any, size: int = 0) -> None:
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires, size)
+        self._bytes += size
+        while len(self._data) > self.maxsize or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        ):
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def pop(self, key: Any) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+def content_hash(data: bytes) -> bytes:
+    """
+    Return a short digest identifying a payload by its contents.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# Smaller PNGs are sent as-is; recompressing them costs more than the upload time it saves
+MIN_RECOMPRESS_BYTES = 64 * 1024
+
+# Recompression needs the optional Pillow package
+PNG_RECOMPRESSION_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+def optimize_png(data: bytes) -> bytes:
+    """
+    Re-encode a PNG at maximum compression, returning the original if that isn't smaller.
+    Blocking; run it in a worker thread.
+    """
+    if len(data) < MIN_RECOMPRESS_BYTES:
+        return data
+    try:
+        # Pillow is optional; without it results are uploaded as Gradio returned them
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            out = io.BytesIO()
+            img.save(
+                out,
+                "PNG",
+                optimize=True,
+                compress_level=9,
+                icc_profile=img.info.get("icc_profile"),
+            )
+    except Exception:
+        return data
+    optimized = out.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+# Segmentation results keyed by (image digest, params) so repeated requests skip SAM;
+# capped by total image size as well as entry count
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_RESULT_CACHE = LRUCache(maxsize=128, max_bytes=RESULT_CACHE_MAX_BYTES)
+
+# Parameter mappings
+PARAM_ALIASES = {
+    "points": "points_per_side",
+    "iou": "iou_threshold",
+    "stability": "stability_threshold",
+    "nms": "box_nms_threshold",
+    "quality": "iou_threshold"  # Alias for quality
+}
+
+# Patterns like "set points to 64" or "points=64", compiled once per alias and
+# tried in order so earlier forms take precedence
+_PARAM_REGEXES = [
+    (param, [
+        re.compile(fr"{alias}\s*[=:]\s*([\d.]+)"),      # points=64 or iou: 0.8
+        re.compile(fr"set\s+{alias}\s+to\s+([\d.]+)"),  # set points to 64
+        re.compile(fr"use\s+([\d.]+)\s+for\s+{alias}"), # use 64 for points
+        re.compile(fr"{alias}\s+([\d.]+)"),              # points 64
+    ])
+    for alias, param in PARAM_ALIASES.items()
+]
+
 def parse_prompt_for_parameters(prompt: str) -> Dict[str, Any]:
     """
     Parse natural language prompt to extract parameter updates.
@@ -22,27 +187,10 @@ def parse_prompt_for_parameters(prompt: str) -> Dict[str, Any]:
     param_updates = {}
     prompt = prompt.lower()
     
-    # Parameter mappings
-    param_aliases = {
-        "points": "points_per_side",
-        "iou": "iou_threshold",
-        "stability": "stability_threshold",
-        "nms": "box_nms_threshold",
-        "quality": "iou_threshold"  # Alias for quality
-    }
-    
     # Look for parameter updates in the prompt
-    for alias, param in param_aliases.items():
-        # Look for patterns like "set points to 64" or "points=64"
-        patterns = [
-            fr"{alias}\s*[=:]\s*([\d.]+)",      # points=64 or iou: 0.8
-            fr"set\s+{alias}\s+to\s+([\d.]+)",  # set points to 64
-            fr"use\s+([\d.]+)\s+for\s+{alias}", # use 64 for points
-            fr"{alias}\s+([\d.]+)"              # points 64
-        ]
-        
+    for param, patterns in _PARAM_REGEXES:
         for pattern in patterns:
-            match = re.search(pattern, prompt)
+            match = pattern.search(prompt)
             if match:
                 try:
                     value = float(match.group(1))
@@ -71,6 +219,156 @@ def parse_prompt_for_parameters(prompt: str) -> Dict[str, Any]:
     
     return param_updates
 
+# Gradio moves each result to download_files/<sha256 of contents>/<name>, so concurrent
+# calls with identical output share one path. Results are therefore only deleted once no
+# prediction is in flight that could be moving a file into that same place.
+_RESULTS_LOCK = threading.Lock()
+_IN_FLIGHT = 0
+_FINISHED_RESULTS: set[str] = set()
+
+def _remove_results(client: Optional[Client], paths: set[str]) -> None:
+    """
+    Delete finished result files and their content-hash directories. Call with _RESULTS_LOCK held.
+    """
+    download_dir = getattr(client, "download_files", None)
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        result_dir = os.path.dirname(os.path.abspath(path))
+        if download_dir and os.path.dirname(result_dir) == os.path.abspath(str(download_dir)):
+            try:
+                os.rmdir(result_dir)
+            except OSError:
+                pass
+
+def _run_sam(image_data: bytes, params: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Run a single blocking SAM prediction and return the segmented image bytes.
+    Intended to be called from a worker thread.
+    """
+    global _IN_FLIGHT
+    # Reuse the shared Gradio client
+    client = get_client()
+    
+    # Stage the image in memory-backed storage for upload; a random name avoids mkstemp's retry loop
+    tmp_path = os.path.join(TMPFS_DIR, f"sam_{uuid4().hex}.png")
+    with open(tmp_path, "wb") as tmp:
+        tmp.write(image_data)
+    
+    with _RESULTS_LOCK:
+        _IN_FLIGHT += 1
+    result = None
+    try:
+        # Call the SAM model with the image and parameters
+        result = client.predict(
+            param_0=handle_file(tmp_path),
+            param_2=params["points_per_side"],
+            param_3=params["iou_threshold"],
+            param_4=params["stability_threshold"],
+            param_5=params["box_nms_threshold"],
+            api_name="/lambda_3"
+        )
+        
+        # Read the result image
+        if result and os.path.exists(result):
+            with open(result, "rb") as f:
+                return f.read()
+        return None
+        
+    finally:
+        # Clean up temporary files; shared result paths wait until nothing else is in flight
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        with _RESULTS_LOCK:
+            _IN_FLIGHT -= 1
+            if result:
+                _FINISHED_RESULTS.add(result)
+            if _IN_FLIGHT == 0:
+                _remove_results(client, _FINISHED_RESULTS)
+                _FINISHED_RESULTS.clear()
+
+# Concurrent requests are coalesced for up to MAX_WAIT seconds into batches of MAX_BATCH
+MAX_BATCH = 8
+MAX_WAIT = 0.02
+
+# At most MAX_IN_FLIGHT distinct SAM calls run at once. Once they are all busy the worker
+# stops draining the bounded queue, so slow inference pushes back on callers
+MAX_IN_FLIGHT = 8
+_SAM_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=MAX_BATCH)
+_BATCH_WORKER: Optional[asyncio.Task] = None
+# In-flight SAM calls, referenced here so they aren't garbage collected mid-run
+_GROUP_TASKS: set[asyncio.Task] = set()
+
+async def _batch_worker() -> None:
+    """
+    Pull queued SAM requests in small batches and start each distinct request once.
+    """
+    loop = asyncio.get_running_loop()
+    # Created here so it belongs to the worker's own event loop
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    while True:
+        batch = [await _SAM_QUEUE.get()]
+        deadline = loop.time() + MAX_WAIT
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_SAM_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Group identical requests so each (image, params) pair hits the server once
+        groups: Dict[Tuple[bytes, tuple], list[asyncio.Future]] = {}
+        for image_data, params, future in batch:
+            key = (image_data, tuple(sorted(params.items())))
+            groups.setdefault(key, []).append(future)
+        
+        # The endpoint takes a single image, so run each group on its own worker thread
+        # without waiting, letting the next batch be collected straight away
+        for (image_data, params), futures in groups.items():
+            await in_flight.acquire()
+            task = asyncio.create_task(asyncio.to_thread(_run_sam, image_data, dict(params)))
+            _GROUP_TASKS.add(task)
+            task.add_done_callback(partial(_resolve_group, futures, in_flight))
+
+def _resolve_group(
+    futures: list[asyncio.Future], in_flight: asyncio.Semaphore, task: asyncio.Task
+) -> None:
+    """
+    Hand the outcome of a finished SAM call to every request waiting on it.
+    """
+    _GROUP_TASKS.discard(task)
+    in_flight.release()
+    for future in futures:
+        if future.done():
+            continue
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+async def _submit_sam(image_data: bytes, params: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Queue a SAM request for the batch worker and wait for its result.
+    """
+    global _BATCH_WORKER, _SAM_QUEUE
+    loop = asyncio.get_running_loop()
+    if _BATCH_WORKER is not None and _BATCH_WORKER.get_loop() is not loop:
+        # The queue and worker belong to a previous event loop and can't be reused
+        _SAM_QUEUE = asyncio.Queue(maxsize=MAX_BATCH)
+        _BATCH_WORKER = None
+    if _BATCH_WORKER is None or _BATCH_WORKER.done():
+        _BATCH_WORKER = asyncio.create_task(_batch_worker())
+    
+    future = loop.create_future()
+    await _SAM_QUEUE.put((image_data, params, future))
+    return await future
+
 async def process_image_with_sam(
     image_data: bytes,
     mime_type: str = "image/png",
@@ -100,55 +398,23 @@ async def process_image_with_sam(
     params.update(sam_params)
     
     # Validate parameters
-    params["points_per_side"] = max(1, min(128, int(params["points_per_side"])))
-    params["iou_threshold"] = max(0.1, min(1.0, float(params["iou_threshold"])))
-    params["stability_threshold"] = max(0.1, min(1.0, float(params["stability_threshold"])))
-    params["box_nms_threshold"] = max(0.1, min(1.0, float(params["box_nms_threshold"])))
+    param_items, analysis = _validate_params(frozenset(params.items()))
+    params = dict(param_items)
+    
+    # Return straight away if this image was already processed with these settings
+    cache_key = (content_hash(image_data), param_items)
+    cached = _RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
     
     try:
-        # Save image to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-            tmp.write(image_data)
-            tmp_path = tmp.name
+        # Hand off to the batch worker, which runs the blocking Gradio call off the event loop
+        result_image = await _submit_sam(image_data, params)
+        if result_image is None:
+            return None, "Failed to process image: No output file was generated"
         
-        try:
-            # Initialize Gradio client
-            client = Client("https://evitsam.hanlab.ai/")
-            
-            # Call the SAM model with the image and parameters
-            result = client.predict(
-                param_0=handle_file(tmp_path),
-                param_2=params["points_per_side"],
-                param_3=params["iou_threshold"],
-                param_4=params["stability_threshold"],
-                param_5=params["box_nms_threshold"],
-                api_name="/lambda_3"
-            )
-            
-            # Read the result image
-            if os.path.exists(result):
-                with open(result, "rb") as f:
-                    result_image = f.read()
-                
-                # Generate analysis text
-                analysis = (
-                    f"Processed image with SAM parameters:\n"
-                    f"- Points per side: {params['points_per_side']}\n"
-                    f"- IoU threshold: {params['iou_threshold']:.2f}\n"
-                    f"- Stability threshold: {params['stability_threshold']:.2f}\n"
-                    f"- Box NMS threshold: {params['box_nms_threshold']:.2f}"
-                )
-                
-                return result_image, analysis
-            else:
-                return None, "Failed to process image: No output file was generated"
-                
-        finally:
-            # Clean up temporary files
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-            if os.path.exists(result):
-                os.unlink(result)
+        _RESULT_CACHE.put(cache_key, (result_image, analysis), size=len(result_image))
+        return result_image, analysis
                 
     except Exception as e:
         return None, f"Error processing image with SAM: {str(e)}"
@@ -177,7 +443,13 @@ async def get_image(
             prompt = item.get("text", "")
             print(f"Extracted prompt: {prompt}")  # Debug log
         elif item.get("type") == "resource" and item.get("mime_type", "").startswith("image/"):
-            image_data = base64.b64decode(item["contents"])
+            contents = item["contents"]
+            # Some transports hand over raw bytes rather than base64 text
+            if isinstance(contents, (bytes, bytearray)):
+                image_data = bytes(contents)
+            else:
+                # a2b_base64 takes the ASCII str directly, avoiding b64decode's full-size encode() copy
+                image_data = binascii.a2b_base64(contents)
             mime_type = item.get("mime_type", "image/png")
     
     if image_data: